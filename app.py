@@ -2,16 +2,20 @@
 # Complete: Telegram webhook bot + promo codes + Stripe checkout (test-ready) + usage limits + users.json storage
 
 import os
-import json
+import time
+import atexit
+import functools
 import logging
-import sqlite3
-import traceback
-from datetime import datetime, date, timedelta
-from flask import Flask, request, jsonify, redirect
-import stripe
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from queue import Queue, Full
+from flask import Flask, Response, request, redirect
+import orjson
 import telegram
 from telegram import Update, ParseMode, Bot
 from telegram.ext import Dispatcher, CommandHandler, MessageHandler, Filters
+from telegram.utils.request import Request
 
 # -------------- Logging --------------
 logging.basicConfig(level=logging.INFO)
@@ -24,14 +28,16 @@ if not TELEGRAM_TOKEN:
     raise SystemExit("Missing TELEGRAM_TOKEN")
 
 BASE_URL = os.getenv("BASE_URL")  # e.g. https://scamshield-bot-xxxxx.onrender.com
+_BASE_URL = (BASE_URL or "").rstrip("/")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_PRICE_ID = os.getenv("STRIPE_PRICE_ID")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 DAILY_LIMIT = int(os.getenv("DAILY_LIMIT", "10"))
-ADMIN_IDS = [x.strip() for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
-
-if STRIPE_SECRET_KEY:
-    stripe.api_key = STRIPE_SECRET_KEY
+USAGE_FLUSH_SECONDS = int(os.getenv("USAGE_FLUSH_SECONDS", "30"))
+DISPATCHER_WORKERS = int(os.getenv("DISPATCHER_WORKERS", "8"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+CHECKOUT_CACHE_SECONDS = int(os.getenv("CHECKOUT_CACHE_SECONDS", "3600"))
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
 
 # -------------- Files and storage --------------
 USERS_FILE = "users.json"          # stores premium expiry per user
@@ -40,14 +46,23 @@ PROMO_FILE = "promo_codes.json"    # promo codes mapping to days
 
 def load_json_file(path):
     try:
-        with open(path, "r") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     except Exception:
         return {}
 
 def save_json_file(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+    # write a sibling temp file, fsync it and rename it over the target so a crash never leaves a torn file
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
 
 # ensure promo file exists (safe default if not present)
 if not os.path.exists(PROMO_FILE):
@@ -58,72 +73,138 @@ if not os.path.exists(PROMO_FILE):
     save_json_file(PROMO_FILE, sample)
 
 # -------------- User/premium helpers --------------
+# users.json is parsed once and kept in memory; writes still go straight to disk
+_users = load_json_file(USERS_FILE)
+_users_lock = threading.Lock()
+
 def get_users():
-    return load_json_file(USERS_FILE)
+    return _users
 
 def save_users(users):
     save_json_file(USERS_FILE, users)
 
+# premium_until is stored as a naive-UTC ISO string; the hot path compares cached epoch seconds
+# instead of parsing it per message. set_premium keeps the cache in sync.
+_premium_cache = {}
+
+def _parse_premium_until(entry):
+    if not entry or not entry.get("premium_until"):
+        return None
+    try:
+        return datetime.fromisoformat(entry["premium_until"])
+    except Exception:
+        return None
+
+def _to_epoch(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def _premium_expiry(uid):
+    if uid in _premium_cache:
+        return _premium_cache[uid]
+    exp = _parse_premium_until(get_users().get(uid))
+    ts = _to_epoch(exp) if exp else 0.0
+    # setdefault: a grant that landed while we were parsing must win over this stale read
+    return _premium_cache.setdefault(uid, ts)
+
 def set_premium(telegram_id, days=30):
-    users = get_users()
-    uid = str(telegram_id)
-    now = datetime.utcnow()
-    current_exp = None
-    if uid in users and users[uid].get("premium_until"):
-        try:
-            current_exp = datetime.fromisoformat(users[uid]["premium_until"])
-        except Exception:
-            current_exp = None
-    if current_exp and current_exp > now:
-        new_exp = current_exp + timedelta(days=days)
-    else:
-        new_exp = now + timedelta(days=days)
-    users[uid] = {"premium_until": new_exp.isoformat()}
-    save_users(users)
+    with _users_lock:
+        users = get_users()
+        uid = str(telegram_id)
+        now = datetime.utcnow()
+        current_exp = _parse_premium_until(users.get(uid))
+        if current_exp and current_exp > now:
+            new_exp = current_exp + timedelta(days=days)
+        else:
+            new_exp = now + timedelta(days=days)
+        entry = {"premium_until": new_exp.isoformat()}
+        # write a copy first and publish only once it is on disk, so a failed save leaves no grant
+        # behind for a retried Stripe webhook to extend again
+        save_users({**users, uid: entry})
+        users[uid] = entry
+        _premium_cache[uid] = _to_epoch(new_exp)
     logger.info("Set premium for %s until %s", uid, new_exp.isoformat())
 
 def is_premium(telegram_id):
-    users = get_users()
-    uid = str(telegram_id)
-    entry = users.get(uid)
-    if not entry:
-        return False
-    exp = entry.get("premium_until")
-    if not exp:
-        return False
-    try:
-        return datetime.fromisoformat(exp) > datetime.utcnow()
-    except Exception:
-        return False
+    return _premium_expiry(str(telegram_id)) > time.time()
 
 # -------------- Usage (daily limits) --------------
+# counters live in memory; a background thread writes usage.json only when they changed
+_usage = load_json_file(USAGE_FILE)
+_usage_lock = threading.Lock()
+_usage_save_lock = threading.Lock()
+_usage_dirty = False
+
 def get_usage():
-    return load_json_file(USAGE_FILE)
+    return _usage
 
 def save_usage(data):
     save_json_file(USAGE_FILE, data)
 
+def flush_usage():
+    global _usage_dirty
+    # held from snapshot to rename so an older snapshot can never land after a newer one
+    with _usage_save_lock:
+        with _usage_lock:
+            if not _usage_dirty:
+                return
+            snapshot = {k: dict(v) for k, v in _usage.items()}
+            _usage_dirty = False
+        try:
+            save_usage(snapshot)
+        except Exception:
+            with _usage_lock:
+                _usage_dirty = True
+            raise
+
+def _usage_flusher():
+    while True:
+        time.sleep(USAGE_FLUSH_SECONDS)
+        try:
+            flush_usage()
+        except Exception:
+            logger.exception("usage flush failed")
+
+threading.Thread(target=_usage_flusher, name="usage-flush", daemon=True).start()
+atexit.register(flush_usage)
+
 def check_and_increment_usage(user_id):
+    global _usage_dirty
     if is_premium(user_id):
         return True, None
-    data = get_usage()
     key = str(user_id)
     today = date.today().isoformat()
-    entry = data.get(key, {"date": today, "count": 0})
-    if entry.get("date") != today:
-        entry = {"date": today, "count": 0}
-    if entry["count"] >= DAILY_LIMIT:
-        data[key] = entry
-        save_usage(data)
-        return False, entry["count"]
-    entry["count"] += 1
-    data[key] = entry
-    save_usage(data)
-    return True, entry["count"]
+    with _usage_lock:
+        data = get_usage()
+        entry = data.get(key)
+        if not entry or entry.get("date") != today:
+            entry = {"date": today, "count": 0}
+            data[key] = entry
+            _usage_dirty = True
+        if entry["count"] >= DAILY_LIMIT:
+            return False, entry["count"]
+        entry["count"] += 1
+        _usage_dirty = True
+        return True, entry["count"]
 
 # -------------- Promo codes --------------
+# promo codes are edited by hand; re-parse the file only when its mtime changes
+_promos = {}
+_promos_mtime = None
+_promos_lock = threading.Lock()
+
 def load_promos():
-    return load_json_file(PROMO_FILE)
+    global _promos, _promos_mtime
+    try:
+        mtime = os.stat(PROMO_FILE).st_mtime_ns
+    except OSError:
+        return {}
+    with _promos_lock:
+        if mtime != _promos_mtime:
+            _promos = load_json_file(PROMO_FILE)
+            _promos_mtime = mtime
+        return _promos
 
 def redeem_code(user_id, code):
     promos = load_promos()
@@ -146,74 +227,198 @@ SUSPICIOUS_KEYWORDS = [
     "claim now", "password", "account suspended", "deposit", "loan"
 ]
 
-def analyze_text_simple(text):
-    txt = (text or "").lower()
+_MAX_REASONS = 6
+
+# (minimum score, verdict, advice), highest band first
+_VERDICT_BANDS = (
+    (60, "High", "Do NOT click links or reply. Verify independently."),
+    (30, "Medium", "Be cautious — verify sender and links."),
+    (0, "Low", "Appears low risk, but always verify."),
+)
+_VERDICT_EMOJI = {"High": "⚠️", "Medium": "❗", "Low": "✅"}
+
+def _finish(score, reasons):
+    score = min(100, score)
+    for threshold, verdict, advice in _VERDICT_BANDS:
+        if score >= threshold:
+            break
+    return verdict, score, tuple(reasons[:_MAX_REASONS]), advice
+
+@functools.lru_cache(maxsize=4096)
+def _analyze_cached(txt):
     reasons = []
     score = 0
+    # every rule is a literal phrase: C-level substring tests on one lowered copy are several
+    # times faster than a case-insensitive regex alternation, which CPython tries branch by branch
+    low = txt.lower()
     for kw in SUSPICIOUS_KEYWORDS:
-        if kw in txt:
+        if kw in low:
             score += 20
             reasons.append(f"Contains '{kw}'")
-    if "http://" in txt or "https://" in txt:
+            # score is saturated and the reasons list is full; later checks can't change the result
+            if len(reasons) == _MAX_REASONS:
+                return _finish(score, reasons)
+    if "http://" in low or "https://" in low:
         score += 15
         reasons.append("Contains URL")
-    if "$" in txt or "usd" in txt:
+    if "$" in low or "usd" in low:
         score += 10
         reasons.append("Money mentioned")
-    score = min(100, score)
-    if score >= 60:
-        verdict = "High"
-        advice = "Do NOT click links or reply. Verify independently."
-    elif score >= 30:
-        verdict = "Medium"
-        advice = "Be cautious — verify sender and links."
-    else:
-        verdict = "Low"
-        advice = "Appears low risk, but always verify."
-    return {"verdict": verdict, "score": score, "reasons": reasons[:6], "advice": advice}
+    return _finish(score, reasons)
+
+def analyze_text_simple(text):
+    # scam texts get forwarded verbatim by many users, so repeats are served from the cache; the
+    # key is the text as-is because normalising it would cost more than analysing it
+    verdict, score, reasons, advice = _analyze_cached(text or "")
+    return {"verdict": verdict, "score": score, "reasons": list(reasons), "advice": advice}
+
+@functools.lru_cache(maxsize=2048)
+def _render_reply(verdict, score, reasons, advice):
+    parts = [
+        f"{_VERDICT_EMOJI.get(verdict, '✅')} *Verdict:* *{verdict}* _(score: {score}/100)_",
+        "",
+    ]
+    if reasons:
+        parts.append("*Top flags:*")
+        parts.extend(f"• {r}" for r in reasons)
+    parts.append("")
+    parts.append(f"*Advice:* {advice}")
+    return "\n".join(parts)
+
+def format_result(result):
+    # few distinct (verdict, score, reasons) combinations exist, so rendered replies are reused
+    return _render_reply(result["verdict"], result["score"], tuple(result["reasons"]), result["advice"])
+
+# -------------- Stripe checkout --------------
+# stripe pulls in requests/urllib3; import it on first payment use rather than at boot
+_stripe = None
+
+def get_stripe():
+    global _stripe
+    if _stripe is None:
+        import stripe
+        if STRIPE_SECRET_KEY:
+            stripe.api_key = STRIPE_SECRET_KEY
+        _stripe = stripe
+    return _stripe
+
+_SUCCESS_URL = _BASE_URL + "/success"
+_CANCEL_URL = _BASE_URL + "/cancel"
+_LINE_ITEMS = [{"price": STRIPE_PRICE_ID, "quantity": 1}]
+
+def create_checkout_session(telegram_id):
+    return get_stripe().checkout.Session.create(
+        payment_method_types=["card"],
+        line_items=_LINE_ITEMS,
+        mode="subscription",
+        success_url=_SUCCESS_URL,
+        cancel_url=_CANCEL_URL,
+        client_reference_id=str(telegram_id) if telegram_id else None,
+    )
+
+# uid -> (checkout url, expires epoch); repeated /upgrade taps reuse the open session
+_checkout_cache = {}
+# uid -> Future for a session being created, so concurrent taps wait for it instead of creating another
+_checkout_pending = {}
+_checkout_lock = threading.Lock()
+
+def checkout_url(telegram_id):
+    if not telegram_id:
+        return create_checkout_session(telegram_id).url
+    key = str(telegram_id)
+    with _checkout_lock:
+        cached = _checkout_cache.get(key)
+        if cached:
+            if cached[1] > time.time():
+                return cached[0]
+            del _checkout_cache[key]
+        pending = _checkout_pending.get(key)
+        owner = pending is None
+        if owner:
+            pending = _checkout_pending[key] = Future()
+    if not owner:
+        return pending.result()
+    try:
+        url = create_checkout_session(telegram_id).url
+    except Exception as e:
+        with _checkout_lock:
+            del _checkout_pending[key]
+        pending.set_exception(e)
+        raise
+    with _checkout_lock:
+        now = time.time()
+        # sweep expired links here, off the hit path, so users who never come back don't pile up
+        for k in [k for k, (_, exp) in _checkout_cache.items() if exp <= now]:
+            del _checkout_cache[k]
+        _checkout_cache[key] = (url, now + CHECKOUT_CACHE_SECONDS)
+        del _checkout_pending[key]
+    pending.set_result(url)
+    return url
+
+def forget_checkout(telegram_id):
+    with _checkout_lock:
+        _checkout_cache.pop(str(telegram_id), None)
 
 # -------------- Telegram bot & Flask --------------
-bot = Bot(token=TELEGRAM_TOKEN)
-dispatcher = Dispatcher(bot, None, workers=4, use_context=True)
+# PTB's default pool holds a single connection; size it for the dispatcher workers plus io_pool
+bot = Bot(
+    token=TELEGRAM_TOKEN,
+    request=Request(con_pool_size=DISPATCHER_WORKERS + IO_WORKERS, connect_timeout=5, read_timeout=10),
+)
+# the webhook only enqueues updates; the consumer threads below run the handlers, so maxsize
+# bounds the backlog. PTB's run_async pool is unused; one worker just keeps it from warning at boot
+update_queue = Queue(maxsize=1000)
+dispatcher = Dispatcher(bot, update_queue, workers=1, use_context=True)
 app = Flask(__name__)
+# slow outbound calls (Stripe, user notifications) run here so they don't hold a dispatcher worker
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="scamshield-io")
+
+def notify_user(telegram_id, text):
+    try:
+        bot.send_message(chat_id=int(telegram_id), text=text)
+    except Exception:
+        logger.exception("Failed to notify user %s via Telegram", telegram_id)
 
 # -------------- Command handlers --------------
+# reply texts that only depend on config, rendered once at import
+_SUBSCRIBE_PREFIX = f"{_BASE_URL}/subscribe?telegram_id=" if BASE_URL else None
+_START_HEAD = (
+    "👋 ScamShield AI — paste a suspicious message and I'll check it.\n\n"
+    f"Free users: {DAILY_LIMIT}/day. Upgrade for unlimited checks.\n\n"
+    "Subscribe (checkout): "
+)
+_START_TAIL = "\nUse /upgrade for one-step checkout, /redeem CODE to use a promo, /status to check plan."
+_STATUS_PREMIUM = "🎉 You are PREMIUM — unlimited checks."
+_STATUS_FREE = f"Free user — {DAILY_LIMIT} checks/day. Use /upgrade or /redeem CODE."
+_LIMIT_REACHED = f"Daily limit reached ({DAILY_LIMIT}). Use /upgrade or /redeem CODE."
+
 def cmd_start(update, context):
     uid = update.message.from_user.id
-    sub = f"{BASE_URL.rstrip('/')}/subscribe?telegram_id={uid}" if BASE_URL else "https://<your-url>/subscribe"
-    text = (
-        "👋 ScamShield AI — paste a suspicious message and I'll check it.\n\n"
-        f"Free users: {DAILY_LIMIT}/day. Upgrade for unlimited checks.\n\n"
-        f"Subscribe (checkout): {sub}\n"
-        "Use /upgrade for one-step checkout, /redeem CODE to use a promo, /status to check plan."
-    )
-    update.message.reply_text(text)
+    sub = _SUBSCRIBE_PREFIX + str(uid) if _SUBSCRIBE_PREFIX else "https://<your-url>/subscribe"
+    update.message.reply_text(_START_HEAD + sub + _START_TAIL)
 
 def cmd_status(update, context):
     uid = update.message.from_user.id
-    if is_premium(uid):
-        update.message.reply_text("🎉 You are PREMIUM — unlimited checks.")
-    else:
-        update.message.reply_text(f"Free user — {DAILY_LIMIT} checks/day. Use /upgrade or /redeem CODE.")
+    update.message.reply_text(_STATUS_PREMIUM if is_premium(uid) else _STATUS_FREE)
+
+def _send_checkout_link(uid, chat_id, message_id):
+    try:
+        text = f"💳 Upgrade to Premium via this secure link:\n{checkout_url(uid)}"
+    except Exception as e:
+        logger.exception("Stripe checkout create failed")
+        text = f"⚠️ Payment link error: {e}"
+    try:
+        bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+    except Exception:
+        logger.exception("Failed to deliver checkout link")
 
 def cmd_upgrade(update, context):
     uid = update.message.from_user.id
     if not STRIPE_SECRET_KEY or not STRIPE_PRICE_ID:
         update.message.reply_text("⚠️ Payments are not configured. Admin needs to set Stripe keys.")
         return
-    try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
-            mode="subscription",
-            success_url=(BASE_URL.rstrip("/") if BASE_URL else "") + "/success",
-            cancel_url=(BASE_URL.rstrip("/") if BASE_URL else "") + "/cancel",
-            client_reference_id=str(uid),
-        )
-        update.message.reply_text(f"💳 Upgrade to Premium via this secure link:\n{session.url}")
-    except Exception as e:
-        logger.exception("Stripe checkout create failed")
-        update.message.reply_text(f"⚠️ Payment link error: {e}")
+    msg = update.message.reply_text("⏳ Generating your secure payment link…")
+    io_pool.submit(_send_checkout_link, uid, msg.chat_id, msg.message_id)
 
 def cmd_redeem(update, context):
     uid = update.message.from_user.id
@@ -226,8 +431,7 @@ def cmd_redeem(update, context):
     update.message.reply_text(msg)
 
 def cmd_grant(update, context):
-    sender = str(update.message.from_user.id)
-    if sender not in ADMIN_IDS:
+    if update.message.from_user.id not in ADMIN_IDS:
         update.message.reply_text("❌ You are not authorized to use this command.")
         return
     args = context.args or []
@@ -257,17 +461,11 @@ def handle_message(update, context):
 
         ok, count = check_and_increment_usage(uid)
         if not ok:
-            update.message.reply_text(f"Daily limit reached ({DAILY_LIMIT}). Use /upgrade or /redeem CODE.")
+            update.message.reply_text(_LIMIT_REACHED)
             return
 
         result = analyze_text_simple(text)
-        reply = f"{'⚠️' if result['verdict']=='High' else '❗' if result['verdict']=='Medium' else '✅'} *Verdict:* *{result['verdict']}* _(score: {result['score']}/100)_\n\n"
-        if result['reasons']:
-            reply += "*Top flags:*\n"
-            for r in result['reasons']:
-                reply += f"• {r}\n"
-        reply += f"\n*Advice:* {result['advice']}"
-        update.message.reply_text(reply, parse_mode=ParseMode.MARKDOWN)
+        update.message.reply_text(format_result(result), parse_mode=ParseMode.MARKDOWN)
     except Exception:
         logger.exception("handle_message failed")
         update.message.reply_text("⚠️ An error occurred while analyzing. Try again later.")
@@ -280,10 +478,21 @@ dispatcher.add_handler(CommandHandler("redeem", cmd_redeem))
 dispatcher.add_handler(CommandHandler("grant", cmd_grant))
 dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
 
+def _process_updates():
+    while True:
+        update = update_queue.get()
+        try:
+            dispatcher.process_update(update)
+        except Exception:
+            logger.exception("Failed to dispatch telegram update")
+
+for i in range(DISPATCHER_WORKERS):
+    threading.Thread(target=_process_updates, name=f"dispatcher-{i}", daemon=True).start()
+
 # -------------- Webhook helpers --------------
 def build_webhook_url():
     if BASE_URL:
-        base = BASE_URL.rstrip("/")
+        base = _BASE_URL
         if not base.startswith("http"):
             base = "https://" + base
     else:
@@ -297,8 +506,11 @@ def build_webhook_url():
 def register_webhook():
     try:
         url = build_webhook_url()
+        # restarts usually find the webhook already in place; skip the re-registration round-trips
+        if bot.get_webhook_info().url == url:
+            logger.info("Telegram webhook already registered")
+            return
         logger.info("Registering Telegram webhook: %s", url)
-        bot.delete_webhook()
         ok = bot.set_webhook(url=url)
         logger.info("set_webhook result: %s", ok)
     except Exception:
@@ -306,21 +518,20 @@ def register_webhook():
         raise
 
 # -------------- Stripe endpoints --------------
+# webhook replies are constant; serialise them once
+_OK_BODY = orjson.dumps({"ok": True})
+_NOT_OK_BODY = orjson.dumps({"ok": False})
+
+def json_reply(body, status=200):
+    return Response(body, status=status, mimetype="application/json")
+
 @app.route("/subscribe", methods=["GET"])
 def subscribe():
     tg = request.args.get("telegram_id")
     if not STRIPE_PRICE_ID or not STRIPE_SECRET_KEY:
         return "Stripe not configured", 500
     try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
-            mode="subscription",
-            success_url=(BASE_URL.rstrip("/") if BASE_URL else "") + "/success",
-            cancel_url=(BASE_URL.rstrip("/") if BASE_URL else "") + "/cancel",
-            client_reference_id=str(tg) if tg else None,
-        )
-        return redirect(session.url, code=302)
+        return redirect(checkout_url(tg), code=302)
     except Exception as e:
         logger.exception("create checkout failed")
         return f"Stripe error: {e}", 500
@@ -333,7 +544,7 @@ def stripe_webhook():
         logger.error("STRIPE_WEBHOOK_SECRET not configured")
         return "Missing webhook secret", 500
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        event = get_stripe().Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
     except Exception:
         logger.exception("Invalid Stripe signature")
         return "Invalid signature", 400
@@ -343,35 +554,38 @@ def stripe_webhook():
         tg = session.get("client_reference_id")
         logger.info("Stripe checkout completed, client_reference_id=%s", tg)
         if tg:
+            forget_checkout(tg)
             set_premium(tg, days=30)
-            try:
-                bot.send_message(chat_id=int(tg), text="🎉 Thank you — your subscription is active! You are now Premium.")
-            except Exception:
-                logger.exception("Failed to notify user via Telegram")
+            io_pool.submit(notify_user, tg, "🎉 Thank you — your subscription is active! You are now Premium.")
     elif event["type"] == "invoice.payment_failed":
         session = event["data"]["object"]
         tg = session.get("client_reference_id")
         if tg:
-            try:
-                bot.send_message(chat_id=int(tg), text="⚠️ We couldn't process your payment. Please update payment method.")
-            except Exception:
-                logger.exception("Failed to notify user of failed payment")
+            io_pool.submit(notify_user, tg, "⚠️ We couldn't process your payment. Please update payment method.")
 
-    return jsonify({"ok": True})
+    return json_reply(_OK_BODY)
 
 # -------------- Telegram webhook route --------------
 @app.route(f"/webhook/{TELEGRAM_TOKEN}", methods=["POST"])
 def telegram_webhook():
     try:
-        data = request.get_json(force=True)
+        data = orjson.loads(request.get_data(cache=False))
+        # every handler needs a text message; ack anything else without building an Update
+        message = data.get("message")
+        if not message or "text" not in message:
+            return json_reply(_OK_BODY)
         update = Update.de_json(data, bot)
-        dispatcher.process_update(update)
-        return jsonify({"ok": True})
+        update_queue.put_nowait(update)
+        return json_reply(_OK_BODY)
+    except Full:
+        logger.warning("Update queue full, asking Telegram to retry")
+        return json_reply(_NOT_OK_BODY, 503)
     except Exception:
         logger.exception("Failed to process telegram update")
-        return jsonify({"ok": False}), 500
+        return json_reply(_NOT_OK_BODY, 500)
 
 # -------------- Start --------------
+# production runs under gunicorn (see gunicorn.conf.py); this is for local runs
 if __name__ == "__main__":
     register_webhook()
     port = int(os.environ.get("PORT", 10000))
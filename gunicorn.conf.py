@@ -0,0 +1,19 @@
+# gunicorn.conf.py
+# Production server settings, used by the Procfile: gunicorn -c gunicorn.conf.py app:app
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+# users, usage counters and the dispatcher live in-process, so run a single
+# worker and get concurrency from threads
+workers = 1
+worker_class = "gthread"
+threads = 8
+# Render's proxy reuses upstream connections; keep them open instead of the 2s default
+keepalive = 30
+
+def post_worker_init(worker):
+    # app is already imported by the worker at this point
+    from app import register_webhook
+    register_webhook()